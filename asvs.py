@@ -2,11 +2,16 @@
 
 import argparse
 import csv
+import hashlib
 import io
 import logging
+import os
 import requests
+import sys
 import xlsxwriter
-from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from itertools import chain
+from pathlib import Path
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
@@ -18,6 +23,29 @@ DEFAULT_OUTPUTS = {
     4: 'OWASP-ASVS-4.0.3.xlsx',
     5: 'OWASP-ASVS-5.0.0.xlsx',
 }
+CACHE_DIR = Path.home() / '.cache' / 'asvs-xgen'
+# 'Fulfilled' column values and their highlight colors.
+_CF_RULES = [
+    ('Yes', '#ECF1DF'),
+    ('No', '#FFC7CE'),
+    ('Partially', '#FFEB9C'),
+    ('Not applicable', '#D3D3D3'),
+]
+# Per-chapter summary formulas - {t} is the requirements table name and {k} the level.
+_LEVEL_TEMPLATES = [
+    '=COUNTA({t}[Level {k}])',
+    '=COUNTIFS({t}[Fulfilled], "Yes", {t}[Level {k}], "<>")',
+    '=COUNTIFS({t}[Fulfilled], "No", {t}[Level {k}], "<>")',
+    '=COUNTIFS({t}[Fulfilled], "Partially", {t}[Level {k}], "<>")',
+    '=COUNTIFS({t}[Fulfilled], "Not applicable", {t}[Level {k}], "<>")',
+    '=COUNTIFS({t}[Fulfilled], "", {t}[Level {k}], "<>")',
+]
+# ASVS 5 lists only the lowest applicable level; maps it to the (level 1, level 2, level 3) markers.
+_V5_LEVELS = {
+    '1': ('✓', '✓', '✓'),
+    '2': ('', '✓', '✓'),
+    '3': ('', '', '✓'),
+}
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
@@ -45,31 +73,110 @@ def parse_args() -> argparse.Namespace:
     return args
 
 def main(asvs_version: int, output_path: str):
-    asvs_csv = download_asvs_csv(asvs_version)
-    worksheet_data = prepare_worksheet_data(asvs_csv, asvs_version)
+    asvs_csv_lines = download_asvs_csv(asvs_version)
+    worksheet_data = prepare_worksheet_data(asvs_csv_lines, asvs_version)
     create_workbook(worksheet_data, output_path)
 
-def download_asvs_csv(asvs_version: int):
-    logging.info(f'Downloading ASVS from {ASVS_CSV_URLS[asvs_version]}')
+def download_asvs_csv(asvs_version: int) -> Iterator[str]:
+    """
+    Streams the ASVS requirements CSV so that parsing can start while the rest of the file is still downloading.
+    The CSV is cached together with its ETag and the cached copy is used when the upstream file is unchanged.
+    :param asvs_version: ASVS version
+    :return: Iterator over the CSV lines
+    """
+
+    url = ASVS_CSV_URLS[asvs_version]
+    cache_path = CACHE_DIR / hashlib.sha1(url.encode()).hexdigest()
+
+    headers = {}
+    etag = _read_cached_etag(cache_path)
+    if etag:
+        headers['If-None-Match'] = etag
 
-    r = requests.get(ASVS_CSV_URLS[asvs_version])
+    logging.info(f'Downloading ASVS from {url}')
+
+    r = requests.get(url, headers=headers, stream=True)
     r.raise_for_status()
-    return r.text
 
-def prepare_worksheet_data(asvs_csv: str, asvs_version: int) -> defaultdict[str, list[list]]:
+    if r.status_code == 304:
+        logging.info(f'ASVS not modified, using cached copy {cache_path}')
+        return _read_cached_csv(cache_path)
+
+    # The ASVS CSV is UTF-8, decode it as such rather than relying on the response headers.
+    r.encoding = 'utf-8'
+    lines = r.iter_lines(chunk_size=65536, decode_unicode=True)
+    etag = r.headers.get('ETag')
+    if not etag:
+        return lines
+    return _cache_csv_lines(lines, cache_path, etag)
+
+def _read_cached_etag(cache_path: Path) -> str | None:
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            return f.readline().rstrip('\n')
+    except FileNotFoundError:
+        return None
+
+def _read_cached_csv(cache_path: Path) -> Iterator[str]:
+    with open(cache_path, encoding='utf-8', newline='') as f:
+        next(f)  # Skip ETag
+        yield from f
+
+def _cache_csv_lines(lines: Iterator[str], cache_path: Path, etag: str) -> Iterator[str]:
+    """
+    Passes the CSV lines through while writing them to the cache. The cache file is only replaced once all lines
+    have been consumed, so an interrupted download never leaves a partial copy behind.
+    :param lines: Downloaded CSV lines
+    :param cache_path: Path of the cache file
+    :param etag: ETag of the downloaded CSV
+    :return: Iterator over the CSV lines
+    """
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix('.tmp')
+
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        f.write(f'{etag}\n')
+        for line in lines:
+            f.write(f'{line}\n')
+            yield line
+
+    os.replace(tmp_path, cache_path)
+
+def _fast_split(line: str, lines: Iterator[str]) -> list[str]:
+    """
+    Splits a CSV line into fields. Lines without quotes are split directly, quoted lines are handed over to the csv
+    module, which consumes any continuation lines of multi-line fields from the remaining lines.
+    :param line: Current CSV line
+    :param lines: Iterator over the remaining CSV lines
+    :return: List of fields, empty for blank lines
+    """
+
+    if '"' not in line:
+        line = line.rstrip('\r\n')
+        return line.split(',') if line else []
+    return next(csv.reader(chain((line,), lines)))
+
+def _row_v4(row: list[str]) -> tuple[str, str, str]:
+    return row[6], row[7], row[8]  # level1, level2, level3
+
+def _row_v5(row: list[str]) -> tuple[str, str, str]:
+    return _V5_LEVELS[row[6]]      # L
+
+def prepare_worksheet_data(asvs_csv_lines: Iterable[str], asvs_version: int) -> dict[str, list[tuple]]:
     """
     Parses ASVS requirements in CVS format and creates a dictionary where the keys correspond to chapter names and
     values to the list of requirements.
-    :param asvs_csv: ASVS requirements CSV content
+    :param asvs_csv_lines: ASVS requirements CSV lines
     :return: Dictionary of chapter names to requirements
     """
 
     logging.info('Preparing worksheet data')
 
-    csv_reader = csv.reader(io.StringIO(asvs_csv))
-    worksheets = defaultdict(list)
+    lines = iter(asvs_csv_lines)
+    worksheets = {}
 
-    next(csv_reader)  # Skip header row
+    next(lines)  # Skip header row
 
     # Expected headers - version 4:
     # 0 - chapter_id
@@ -92,30 +199,39 @@ def prepare_worksheet_data(asvs_csv: str, asvs_version: int) -> defaultdict[str,
     # 5 - req_description
     # 6 - L
 
-    for row in csv_reader:
+    if asvs_version == 4:
+        pick_levels = _row_v4
+    elif asvs_version == 5:
+        pick_levels = _row_v5
+    else:
+        raise ValueError('Version must be 4 or 5')
+
+    # Rows are ordered by chapter, so the requirement list is only looked up when the chapter changes. Chapter names
+    # are interned, so an identity check suffices.
+    current_chapter = None
+    current_requirements = None
+
+    for line in lines:
+        row = _fast_split(line, lines)
+
         # Skip empty rows
         if not row:
             continue
 
-        chapter = f'{row[0]} {row[1]}'             # chapter_id + chapter_name
+        chapter = sys.intern(f'{row[0]} {row[1]}') # chapter_id + chapter_name
         req_id = row[4][1:]                        # req_id
-        section = row[3]                           # section_name
+        section = sys.intern(row[3])               # section_name
         req = row[5]                               # req_description
-        if asvs_version == 4:
-            l1 = row[6]                            # level1
-            l2 = row[7]                            # level2
-            l3 = row[8]                            # level3
-        elif asvs_version == 5:
-            l1 = '✓' if int(row[6]) <= 1 else ''   # level1
-            l2 = '✓' if int(row[6]) <= 2 else ''   # level2
-            l3 = '✓' if int(row[6]) <= 3 else ''   # level3
-        else:
-            raise ValueError('Version must be 4 or 5')
+        l1, l2, l3 = pick_levels(row)              # level1, level2, level3
 
         fulfilled = ''
         comment = ''
 
-        worksheets[chapter].append([
+        if chapter is not current_chapter:
+            current_chapter = chapter
+            current_requirements = worksheets.setdefault(chapter, [])
+
+        current_requirements.append((
             req_id,
             section,
             req,
@@ -123,11 +239,11 @@ def prepare_worksheet_data(asvs_csv: str, asvs_version: int) -> defaultdict[str,
             l2,
             l3,
             fulfilled,
-            comment])
+            comment))
 
     return worksheets
 
-def create_workbook(worksheets: defaultdict[str, list[list]], output_path: str) -> str:
+def create_workbook(worksheets: dict[str, list[tuple]], output_path: str) -> str:
     """
     Creates ASVS Excel workbook based on the provided data.
     :param worksheets: Dictionary of chapter names to requirements
@@ -137,15 +253,45 @@ def create_workbook(worksheets: defaultdict[str, list[list]], output_path: str)
 
     logging.info('Creating workbook')
 
-    workbook = xlsxwriter.Workbook(output_path)
+    # The workbook is assembled in memory and written to the output file at once. Requirement texts are plain text,
+    # skip scanning them for URLs. Formula detection stays enabled as the summary tables pass their formulas as strings.
+    workbook_buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(workbook_buffer, {'in_memory': True, 'strings_to_urls': False})
 
     # Summary worksheet - Added now so that it is the first one.
     workbook.add_worksheet("Summary")
 
+    # Requirements table names - Chapter postfix, i.e., table_v1, table_v2, table_v3, ...etc...
+    table_names = {sheet_name: f'table_{sheet_name.split(" ", 1)[0].lower()}' for sheet_name in worksheets}
+
     # --------------------------------------------------
     # Chapter worksheets
     # --------------------------------------------------
-    
+
+    # Requirements table column formatting - Shared by all chapter worksheets.
+    requirement_id_fmt = workbook.add_format({'align': 'center', 'valign': 'vcenter'})
+    section_fmt = workbook.add_format({'align': 'left', 'valign': 'vcenter'})
+    requirement_fmt = workbook.add_format({'align': 'left', 'valign': 'top', 'text_wrap': True})
+    level_fmt_props = {'align': 'center', 'valign': 'vcenter', 'text_wrap': True}
+    l1_fmt = workbook.add_format({**level_fmt_props, 'bg_color': '#DCE6F1'})
+    l2_fmt = workbook.add_format({**level_fmt_props, 'bg_color': '#B8CCE4'})
+    l3_fmt = workbook.add_format({**level_fmt_props, 'bg_color': '#95B3D7'})
+    fulfilled_fmt = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'text_wrap': True})
+    comment_fmt = workbook.add_format({'align': 'left', 'valign': 'top', 'text_wrap': True})
+    requirement_columns = [
+        {'header': 'Requirement ID', 'format': requirement_id_fmt},
+        {'header': 'Section', 'format': section_fmt},
+        {'header': 'Requirement', 'format': requirement_fmt},
+        {'header': 'Level 1', 'format': l1_fmt},
+        {'header': 'Level 2', 'format': l2_fmt},
+        {'header': 'Level 3', 'format': l3_fmt},
+        {'header': 'Fulfilled', 'format': fulfilled_fmt},
+        {'header': 'Comment', 'format': comment_fmt},
+    ]
+
+    # 'Fulfilled' column conditional formatting - Shared by all chapter worksheets.
+    cf_fmts = {value: workbook.add_format({'bg_color': color}) for value, color in _CF_RULES}
+
     for sheet_name, data in worksheets.items():
         # Worksheet - Sheet name cannot exceed 30 chars
         worksheet = workbook.add_worksheet(sheet_name[:30])
@@ -163,61 +309,31 @@ def create_workbook(worksheets: defaultdict[str, list[list]], output_path: str)
         worksheet.set_column('G:G', 10)  # Fulfilled
         worksheet.set_column('H:H', 50)  # Comment
 
-        # Requirements table column formatting
-        requirement_id_fmt = workbook.add_format({'align': 'center', 'valign': 'vcenter'})
-        section_fmt = workbook.add_format({'align': 'left', 'valign': 'vcenter'})
-        requirement_fmt = workbook.add_format({'align': 'left', 'valign': 'top', 'text_wrap': True})
-        level_fmt_props = {'align': 'center', 'valign': 'vcenter', 'text_wrap': True}
-        l1_fmt = workbook.add_format({**level_fmt_props, 'bg_color': '#DCE6F1'})
-        l2_fmt = workbook.add_format({**level_fmt_props, 'bg_color': '#B8CCE4'})
-        l3_fmt = workbook.add_format({**level_fmt_props, 'bg_color': '#95B3D7'})
-        fulfilled_fmt = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'text_wrap': True})
-        comment_fmt = workbook.add_format({'align': 'left', 'valign': 'top', 'text_wrap': True})
-
-        # Requirements table - Table name contains chapter postfix, i.e., table_v1, table_v2, table_v3, ...etc...
-        table_name = f'table_{sheet_name.split(" ")[0].lower()}'
+        # Requirements - Written column by column with the column format, the table only adds the structure.
+        for col, values in enumerate(zip(*data)):
+            worksheet.write_column(1, col, values, requirement_columns[col]['format'])
+
+        # Requirements table
         worksheet.add_table(0, 0, len(data), 7, {
-            'name': table_name,
-            'columns': [
-                {'header': 'Requirement ID', 'format': requirement_id_fmt},
-                {'header': 'Section', 'format': section_fmt},
-                {'header': 'Requirement', 'format': requirement_fmt},
-                {'header': 'Level 1', 'format': l1_fmt},
-                {'header': 'Level 2', 'format': l2_fmt},
-                {'header': 'Level 3', 'format': l3_fmt},
-                {'header': 'Fulfilled', 'format': fulfilled_fmt},
-                {'header': 'Comment', 'format': comment_fmt},
-            ],
-            'style': 'Table Style Light 9',
-            'data': data})
+            'name': table_names[sheet_name],
+            'columns': requirement_columns,
+            'style': 'Table Style Light 9'})
 
         # 'Fulfilled' column dropdown selection
-        for row in range(1, len(data) + 2):
-            worksheet.data_validation(f'G{row}', {
-                'validate': 'list',
-                'source': ['Yes', 'No', 'Partially', 'Not applicable'],
-                'error_message': 'Invalid input. Choose Yes, No, Partially or Not applicable.',
-                'error_title': 'Invalid Input',
-            })
+        worksheet.data_validation(1, 6, len(data), 6, {
+            'validate': 'list',
+            'source': ['Yes', 'No', 'Partially', 'Not applicable'],
+            'error_message': 'Invalid input. Choose Yes, No, Partially or Not applicable.',
+            'error_title': 'Invalid Input',
+        })
 
         # 'Fulfilled' column conditional formatting
         fulfilled_range = f"G2:G{len(data) + 1}"
-        worksheet.conditional_format(fulfilled_range, {'type': 'cell',
-                                                       'criteria': '==',
-                                                       'value': '"Yes"',
-                                                       'format': workbook.add_format({'bg_color': '#ECF1DF'})})
-        worksheet.conditional_format(fulfilled_range, {'type': 'cell',
-                                                       'criteria': '==',
-                                                       'value': '"No"',
-                                                       'format': workbook.add_format({'bg_color': '#FFC7CE'})})
-        worksheet.conditional_format(fulfilled_range, {'type': 'cell',
-                                                       'criteria': '==',
-                                                       'value': '"Partially"',
-                                                       'format': workbook.add_format({'bg_color': '#FFEB9C'})})
-        worksheet.conditional_format(fulfilled_range, {'type': 'cell',
-                                                       'criteria': '==',
-                                                       'value': '"Not applicable"',
-                                                       'format': workbook.add_format({'bg_color': '#D3D3D3'})})
+        for value, _ in _CF_RULES:
+            worksheet.conditional_format(fulfilled_range, {'type': 'cell',
+                                                           'criteria': '==',
+                                                           'value': f'"{value}"',
+                                                           'format': cf_fmts[value]})
 
     # --------------------------------------------------
     # Summary worksheet
@@ -257,16 +373,7 @@ def create_workbook(worksheets: defaultdict[str, list[list]], output_path: str)
     table_last_row = 4
 
     def build_level_formulas(target_table: str, level: int) -> list[str]:
-        level_name = f'Level {level}'
-        return [
-            level_name,
-            f'=COUNTA({target_table}[{level_name}])',
-            f'=COUNTIFS({target_table}[Fulfilled], "Yes", {target_table}[{level_name}], "<>")',
-            f'=COUNTIFS({target_table}[Fulfilled], "No", {target_table}[{level_name}], "<>")',
-            f'=COUNTIFS({target_table}[Fulfilled], "Partially", {target_table}[{level_name}], "<>")',
-            f'=COUNTIFS({target_table}[Fulfilled], "Not applicable", {target_table}[{level_name}], "<>")',
-            f'=COUNTIFS({target_table}[Fulfilled], "", {target_table}[{level_name}], "<>")',
-        ]
+        return [f'Level {level}', *(template.format(t=target_table, k=level) for template in _LEVEL_TEMPLATES)]
 
     for sheet_name in worksheets.keys():
         # Chapter heading
@@ -274,7 +381,7 @@ def create_workbook(worksheets: defaultdict[str, list[list]], output_path: str)
         worksheet.merge_range(heading_row, 0, heading_row, 5, None)
 
         # Fulfillment statistics per level and chapter:
-        target_table = f'table_{sheet_name.split(" ")[0].lower()}'
+        target_table = table_names[sheet_name]
         data = [
             build_level_formulas(target_table, 1),
             build_level_formulas(target_table, 2),
@@ -303,42 +410,18 @@ def create_workbook(worksheets: defaultdict[str, list[list]], output_path: str)
         3: 5,
     }
 
-    def rows_for_level(level: int) -> list[int]:
-        first_row = data_row_offsets[level]
-        return list(range(first_row, len(worksheets) * row_offset, row_offset))
+    level_rows = {
+        level: range(first_row, len(worksheets) * row_offset, row_offset)
+        for level, first_row in data_row_offsets.items()
+    }
 
-    def sum_column(col_letter: str, rows: list[int]) -> str:
-        return f'=SUM({",".join([f"{col_letter}{row}" for row in rows])})'
+    def sum_column(col_letter: str, rows: range) -> str:
+        return f'=SUM({",".join(f"{col_letter}{row}" for row in rows)})'
 
+    # Fulfillment statistics per level across all chapters:
     formulas = [
-        # Fulfillment statistics per level across all chapters:
-        [
-            'Level 1',
-            sum_column("B", rows_for_level(1)),
-            sum_column("C", rows_for_level(1)),
-            sum_column("D", rows_for_level(1)),
-            sum_column("E", rows_for_level(1)),
-            sum_column("F", rows_for_level(1)),
-            sum_column("G", rows_for_level(1)),
-        ],
-        [
-            'Level 2',
-            sum_column("B", rows_for_level(2)),
-            sum_column("C", rows_for_level(2)),
-            sum_column("D", rows_for_level(2)),
-            sum_column("E", rows_for_level(2)),
-            sum_column("F", rows_for_level(2)),
-            sum_column("G", rows_for_level(2)),
-        ],
-        [
-            'Level 3',
-            sum_column("B", rows_for_level(3)),
-            sum_column("C", rows_for_level(3)),
-            sum_column("D", rows_for_level(3)),
-            sum_column("E", rows_for_level(3)),
-            sum_column("F", rows_for_level(3)),
-            sum_column("G", rows_for_level(3)),
-        ],
+        [f'Level {level}', *(sum_column(col_letter, rows) for col_letter in 'BCDEFG')]
+        for level, rows in level_rows.items()
     ]
 
     summary_heading_row = len(worksheets) * 5
@@ -390,6 +473,9 @@ def create_workbook(worksheets: defaultdict[str, list[list]], output_path: str)
 
     workbook.close()
 
+    with open(output_path, 'wb') as f:
+        f.write(workbook_buffer.getbuffer())
+
     logging.info(f'Workbook saved as {output_path}')
 
 if __name__ == '__main__':